@@ -11,23 +11,42 @@ Uses NexaDB's vector search for fast semantic retrieval.
 
 import os
 import io
-import uuid
+import asyncio
+import secrets
 import hashlib
+import json
+import re
+import functools
 from datetime import datetime, timezone
 from typing import Optional
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-import tiktoken
 import openai
 from nexaclient import NexaClient
 from pypdf import PdfReader
 
+# Prefer riptoken (tiktoken-compatible Rust tokenizer) when installed
+try:
+    import riptoken as _tok
+except ImportError:
+    import tiktoken as _tok
+
+import numpy as np
+
+# numba JIT-compiles the word-based fallback chunker when installed
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 # Load environment variables
 load_dotenv()
 
@@ -40,22 +59,71 @@ NEXADB_PASSWORD = os.getenv("NEXADB_PASSWORD", "nexadb123")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1536"))
 LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+EMBED_QUANT = os.getenv("EMBED_QUANT", "fp32").lower()  # "fp32" or "int8"
 
 # Database and collection names
 DATABASE = "rag_knowledge_base"
 DOCUMENTS_COLLECTION = "documents"
 CHUNKS_COLLECTION = "chunks"
+EMBEDDING_CACHE_COLLECTION = "embedding_cache"
+STATS_COLLECTION = "stats"
+STATS_ID = "totals"  # id of the singleton stats document
+STATS_SEED_LIMIT = 100000  # max documents scanned when first building the stats document
 
 # Chunking configuration
 CHUNK_SIZE = 500  # tokens
 CHUNK_OVERLAP = 50  # tokens
 
-# Global client
+# Embedding batching (OpenAI accepts up to 2048 inputs / ~300k tokens per request;
+# 96 chunks of CHUNK_SIZE tokens stays well under both limits)
+EMBEDDING_BATCH_SIZE = 96
+EMBEDDING_MAX_CONCURRENCY = 5  # in-flight embedding requests across the whole process
+EMBEDDING_MAX_RETRIES = 5
+EMBEDDING_MAX_RETRY_DELAY = 30  # seconds; caps backoff and Retry-After
+
+# Upload pipeline: chunks are embedded and inserted in steps of UPLOAD_BATCH_SIZE,
+# with at most UPLOAD_QUEUE_SIZE embedded steps waiting to be inserted
+UPLOAD_BATCH_SIZE = EMBEDDING_BATCH_SIZE * EMBEDDING_MAX_CONCURRENCY
+UPLOAD_QUEUE_SIZE = 4
+
+# Page size when deleting by filter (NexaClient deletes one document per call)
+DELETE_PAGE_SIZE = 1000
+
+# Matryoshka shortlist: search truncated vectors first, then rerank on full vectors.
+# Truncated vectors live in their own collection, since vector_search only searches
+# a collection's "vector" field.
+SHORTLIST_COLLECTION = "chunk_shortlist"
+SHORTLIST_DIMENSIONS = 256
+SHORTLIST_CANDIDATES = 200
+SHORTLIST_BACKFILL_LIMIT = 100000  # max chunks checked for missing shortlist entries
+SHORTLIST_BACKFILL_PAGE = 500
+USE_SHORTLIST = EMBEDDING_DIMENSIONS > SHORTLIST_DIMENSIONS
+
+# Brute-force fallback index, used when NexaDB vector search is unavailable
+FALLBACK_INDEX_LIMIT = 100000  # max chunks loaded into memory
+FALLBACK_MAX_BLOCKS = 64  # appended blocks before they are merged into one matrix
+FALLBACK_LOAD_ATTEMPTS = 3  # reloads when writes land while the index is loading
+
+# PDF text cleanup (precompiled; substitution runs in C)
+_BAD_RE = re.compile(r"[\x00-\x08\x0e-\x1f]")  # control characters (\v and \f count as whitespace)
+_WS_RE = re.compile(r"[^\S\n]+")  # runs of whitespace other than newlines
+_PARAGRAPH_RE = re.compile(r"\s*\n\s*\n\s*")  # blank-line runs between paragraphs
+
+# Tokenizer, loaded once (None if unavailable, e.g. offline without a cached BPE file)
+try:
+    _ENCODING = _tok.encoding_for_model("gpt-4")
+except Exception:
+    _ENCODING = None
+
+# Global clients
+db_client: Optional[NexaClient] = None
 openai_client: Optional[openai.OpenAI] = None
+async_openai_client: Optional[openai.AsyncOpenAI] = None
+embedding_semaphore: Optional[asyncio.Semaphore] = None
 
 
-def get_client() -> NexaClient:
-    """Create a fresh NexaDB client connection for each request."""
+def new_client() -> NexaClient:
+    """Open a new NexaDB connection."""
     client = NexaClient(
         host=NEXADB_HOST,
         port=NEXADB_PORT,
@@ -66,6 +134,55 @@ def get_client() -> NexaClient:
     return client
 
 
+def _connected_client() -> NexaClient:
+    """Get or create the shared NexaDB connection."""
+    global db_client
+    if db_client is None:
+        db_client = new_client()
+    return db_client
+
+
+def reset_client():
+    """Drop the shared NexaDB connection so the next call reconnects."""
+    global db_client
+    if db_client is not None:
+        try:
+            db_client.disconnect()
+        except Exception:
+            pass
+        db_client = None
+
+
+class ReconnectingClient:
+    """Proxy for the shared NexaClient that resets it after a socket error.
+
+    NexaClient keeps reporting itself connected after its socket dies, so a
+    connection error drops it here and the next call opens a fresh one.
+    """
+
+    def __getattr__(self, name):
+        attr = getattr(_connected_client(), name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            except (ConnectionError, OSError):
+                reset_client()
+                raise
+
+        return call
+
+
+_shared_client = ReconnectingClient()
+
+
+def get_client() -> NexaClient:
+    """Get the shared NexaDB client (reconnects after connection errors)."""
+    return _shared_client
+
+
 def get_openai_client() -> openai.OpenAI:
     """Get or create OpenAI client."""
     global openai_client
@@ -76,61 +193,106 @@ def get_openai_client() -> openai.OpenAI:
     return openai_client
 
 
+def get_async_openai_client() -> openai.AsyncOpenAI:
+    """Get or create async OpenAI client."""
+    global async_openai_client
+    if async_openai_client is None:
+        if not OPENAI_API_KEY:
+            raise HTTPException(status_code=500, detail="OPENAI_API_KEY not configured")
+        async_openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return async_openai_client
+
+
 def generate_id() -> str:
     """Generate a unique ID."""
-    return uuid.uuid4().hex[:16]
+    return secrets.token_hex(8)
 
 
-def count_tokens(text: str) -> int:
-    """Count tokens in text using tiktoken."""
-    try:
-        encoding = tiktoken.encoding_for_model("gpt-4")
-        return len(encoding.encode(text))
-    except:
-        # Fallback: rough estimate
-        return len(text) // 4
+def count_tokens_batch(texts: list[str]) -> list[int]:
+    """Count tokens for many texts in one call (encoded in parallel by the Rust core)."""
+    if _ENCODING is None:
+        return [len(text) // 4 for text in texts]
+    return [len(tokens) for tokens in _ENCODING.encode_ordinary_batch(texts)]
+
+
+@njit(cache=True)
+def _chunk_by_words(word_sizes: np.ndarray, chunk_size: int, overlap: int) -> tuple[np.ndarray, np.ndarray]:
+    """Word-index bounds [start, end) of overlapping chunks, from estimated word token sizes."""
+    n = len(word_sizes)
+    starts = np.empty(n, dtype=np.int64)
+    ends = np.empty(n, dtype=np.int64)
+    count = 0
+    start = 0
+    current_size = 0
+    keep = -(-overlap // 4)  # words kept for overlap, matching list[-overlap//4:]
+
+    for i in range(n):
+        if current_size + word_sizes[i] > chunk_size and i > start:
+            starts[count] = start
+            ends[count] = i
+            count += 1
+            # Keep overlap
+            start = max(start, i - keep) if overlap > 0 else i
+            current_size = 0
+            for j in range(start, i):
+                current_size += word_sizes[j]
+        current_size += word_sizes[i]
+
+    if n > start:
+        starts[count] = start
+        ends[count] = n
+        count += 1
+
+    return starts[:count], ends[:count]
 
 
 def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
     """Split text into overlapping chunks based on token count."""
-    try:
-        encoding = tiktoken.encoding_for_model("gpt-4")
-        tokens = encoding.encode(text)
-    except:
+    if _ENCODING is None:
         # Fallback to character-based chunking
         words = text.split()
-        chunks = []
-        current_chunk = []
-        current_size = 0
-
-        for word in words:
-            word_size = len(word) // 4 + 1
-            if current_size + word_size > chunk_size and current_chunk:
-                chunks.append(" ".join(current_chunk))
-                # Keep overlap
-                overlap_words = current_chunk[-overlap//4:] if overlap > 0 else []
-                current_chunk = overlap_words
-                current_size = sum(len(w)//4 + 1 for w in current_chunk)
-            current_chunk.append(word)
-            current_size += word_size
-
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
-        return chunks
+        word_sizes = np.fromiter((len(w) // 4 + 1 for w in words), dtype=np.int64, count=len(words))
+        starts, ends = _chunk_by_words(word_sizes, chunk_size, overlap)
+        return [" ".join(words[start:end]) for start, end in zip(starts, ends)]
+
+    tokens = _ENCODING.encode_ordinary(text)
+    step = chunk_size - overlap
+
+    # Character offset of every token, so windows can be sliced from the original text
+    decoded, offsets = _ENCODING.decode_with_offsets(tokens)
+    if decoded != text:
+        # Text does not round-trip (e.g. invalid surrogates): decode each window instead
+        return [
+            _ENCODING.decode(tokens[start:start + chunk_size])
+            for start in range(0, len(tokens), step)
+        ]
 
     chunks = []
-    start = 0
-
-    while start < len(tokens):
-        end = min(start + chunk_size, len(tokens))
-        chunk_tokens = tokens[start:end]
-        chunk_text = encoding.decode(chunk_tokens)
-        chunks.append(chunk_text)
-        start += chunk_size - overlap
+    for start in range(0, len(tokens), step):
+        end = start + chunk_size
+        char_end = offsets[end] if end < len(tokens) else len(text)
+        chunks.append(text[offsets[start]:char_end])
 
     return chunks
 
 
+def extract_pdf_text(stream) -> str:
+    """Extract text from all pages of a PDF file object."""
+    pdf_reader = PdfReader(stream)
+    text_parts = []
+    for page in pdf_reader.pages:
+        page_text = page.extract_text()
+        if page_text:
+            text_parts.append(page_text)
+    return clean_pdf_text("\n\n".join(text_parts))
+
+
+def clean_pdf_text(text: str) -> str:
+    """Normalize whitespace and strip control characters from extracted PDF text."""
+    text = _WS_RE.sub(" ", _BAD_RE.sub("", text))
+    return _PARAGRAPH_RE.sub("\n\n", text).strip()
+
+
 def create_embedding(text: str) -> list[float]:
     """Create embedding for text using OpenAI."""
     client = get_openai_client()
@@ -142,6 +304,447 @@ def create_embedding(text: str) -> list[float]:
     return response.data[0].embedding
 
 
+def quantize_int8(vector: list[float]) -> tuple[list[int], float]:
+    """Quantize a vector to int8 with a per-vector scale (x ~= q * scale)."""
+    v = np.asarray(vector, dtype=np.float32)
+    scale = float(np.abs(v).max()) / 127 or 1.0
+    return np.rint(v / scale).astype(np.int8).tolist(), scale
+
+
+def _encode_vector(vector) -> list:
+    """Vector as stored/searched, quantized to int8 when EMBED_QUANT=int8."""
+    if EMBED_QUANT == "int8":
+        return quantize_int8(vector)[0]
+    return list(vector)
+
+
+def shortlist_vector(vector: list[float]) -> list:
+    """Truncated, re-normalized Matryoshka vector used for the shortlist search."""
+    v = np.asarray(vector[:SHORTLIST_DIMENSIONS], dtype=np.float32)
+    v /= np.linalg.norm(v) or 1.0
+    return _encode_vector(v.tolist())
+
+
+def vector_fields(vector: list[float]) -> dict:
+    """Vector fields to store for a chunk, honoring EMBED_QUANT."""
+    if EMBED_QUANT == "int8":
+        quantized, scale = quantize_int8(vector)
+        return {"vector": quantized, "vector_scale": scale}
+    return {"vector": vector}
+
+
+def shortlist_doc(chunk_id: str, document_id: str, vector: list[float]) -> dict:
+    """Shortlist collection entry pointing back at a chunk."""
+    return {"chunk_id": chunk_id, "document_id": document_id, "vector": shortlist_vector(vector)}
+
+
+def query_vector(vector: list[float]) -> list:
+    """Search vector for a question, quantized the same way as stored chunks.
+
+    Cosine similarity is scale-invariant, so int8 queries score correctly
+    against int8 chunks without dequantizing.
+    """
+    return _encode_vector(vector)
+
+
+def rerank(candidates: list[dict], vector: list[float], top_k: int) -> list[dict]:
+    """Rerank candidate chunks by cosine similarity against their full vectors."""
+    if not candidates:
+        return []
+    mat = np.asarray([c["vector"] for c in candidates], dtype=np.float32)
+    q = np.asarray(vector, dtype=np.float32)
+    norms = np.linalg.norm(mat, axis=1) * np.linalg.norm(q)
+    scores = (mat @ q) / np.where(norms == 0, 1.0, norms)
+    order = np.argsort(-scores)[:top_k]
+    return [{**candidates[i], "_score": float(scores[i])} for i in order]
+
+
+@functools.lru_cache(maxsize=1024)
+def _embed_cached(text: str) -> tuple[float, ...]:
+    """Create embedding for a query, memoized in-process (tuple so it is hashable)."""
+    return tuple(create_embedding(text))
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying, honoring Retry-After when present (capped)."""
+    delay = 2 ** attempt
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                pass
+    return min(max(delay, 0), EMBEDDING_MAX_RETRY_DELAY)
+
+
+def get_embedding_semaphore() -> asyncio.Semaphore:
+    """Get or create the process-wide limit on in-flight embedding requests."""
+    global embedding_semaphore
+    if embedding_semaphore is None:
+        embedding_semaphore = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+    return embedding_semaphore
+
+
+async def _embed_sub_batch(texts: list[str]) -> list[list[float]]:
+    """Embed one sub-batch, retrying on rate limits and transient errors."""
+    # Retries are handled here so backoff sleeps happen outside the semaphore
+    client = get_async_openai_client().with_options(max_retries=0)
+    for attempt in range(EMBEDDING_MAX_RETRIES):
+        try:
+            async with get_embedding_semaphore():
+                response = await client.embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=texts,
+                    dimensions=EMBEDDING_DIMENSIONS
+                )
+            break
+        except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+            if attempt == EMBEDDING_MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(_retry_delay(e, attempt))
+    # Responses carry an index per input; sort to be safe about ordering
+    return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+
+async def create_embeddings_batch(texts: list[str]) -> list[list[float]]:
+    """Create embeddings for many texts, running sub-batches concurrently."""
+    sub_batches = [
+        texts[start:start + EMBEDDING_BATCH_SIZE]
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(*(_embed_sub_batch(sub) for sub in sub_batches))
+    # gather preserves input order, so flattening keeps embeddings aligned with texts
+    return [embedding for batch in results for embedding in batch]
+
+
+def embedding_cache_key(text: str) -> str:
+    """Cache key for an embedding: (sha256(text), model, dimensions)."""
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{text_hash}:{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}"
+
+
+async def create_embeddings_cached(db: NexaClient, texts: list[str]) -> list[list[float]]:
+    """Create embeddings, reusing cached vectors and only calling OpenAI for misses."""
+    # Deduplicate identical texts (repeated headers, footers, notices) preserving order
+    unique_texts = list(dict.fromkeys(texts))
+    keys = [embedding_cache_key(text) for text in unique_texts]
+
+    # Batch-lookup cached embeddings; a cache failure just means everything is a miss
+    cached = {}
+    try:
+        entries = db.query(
+            EMBEDDING_CACHE_COLLECTION,
+            {"key": {"$in": keys}},
+            limit=len(keys),
+            database=DATABASE
+        )
+        cached = {entry["key"]: entry["vector"] for entry in entries}
+    except Exception:
+        pass
+
+    uncached_indices = [i for i, key in enumerate(keys) if key not in cached]
+    uncached_texts = [unique_texts[i] for i in uncached_indices]
+
+    emb_map = {text: cached.get(key) for text, key in zip(unique_texts, keys)}
+    if uncached_texts:
+        new_embeddings = await create_embeddings_batch(uncached_texts)
+        for i, embedding in zip(uncached_indices, new_embeddings):
+            emb_map[unique_texts[i]] = embedding
+        try:
+            create_many(
+                db,
+                EMBEDDING_CACHE_COLLECTION,
+                [{"key": keys[i], "vector": embedding} for i, embedding in zip(uncached_indices, new_embeddings)]
+            )
+        except Exception:
+            pass
+
+    # Fan results back out to the original positions
+    return [emb_map[text] for text in texts]
+
+
+def create_many(db: NexaClient, collection: str, docs: list[dict]):
+    """Insert many documents in one round-trip, falling back to per-document inserts."""
+    if not docs:
+        return
+    if hasattr(db, "batch_write"):
+        db.batch_write(collection, docs, database=DATABASE)
+    else:
+        for doc in docs:
+            db.create(collection, doc, database=DATABASE)
+
+
+def delete_many(db: NexaClient, collection: str, filters: dict) -> int:
+    """Delete all documents matching filters, a page at a time; returns the number removed."""
+    removed = 0
+    while True:
+        docs = db.query(collection, filters, limit=DELETE_PAGE_SIZE, database=DATABASE)
+        page_removed = 0
+        for doc in docs:
+            try:
+                db.delete(collection, doc["_id"], database=DATABASE)
+                page_removed += 1
+            except:
+                pass
+        removed += page_removed
+        # Stop once nothing matches, or nothing on this page could be deleted
+        if page_removed == 0:
+            return removed
+
+
+async def store_chunks(db: NexaClient, doc_id: str, filename: str, chunks: list[str], chunk_tokens: list[int]):
+    """Embed and insert chunks as a producer/consumer pipeline, bounding in-flight memory."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+
+    async def produce():
+        try:
+            for start in range(0, len(chunks), UPLOAD_BATCH_SIZE):
+                embeddings = await create_embeddings_cached(db, chunks[start:start + UPLOAD_BATCH_SIZE])
+                await queue.put((start, embeddings))
+        finally:
+            await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (item := await queue.get()) is not None:
+            start, embeddings = item
+            chunk_docs = [
+                {
+                    "id": generate_id(),
+                    "document_id": doc_id,
+                    "document_name": filename,
+                    "chunk_index": i,
+                    "text": chunks[i],
+                    **vector_fields(embedding),
+                    "tokens": chunk_tokens[i],
+                }
+                for i, embedding in enumerate(embeddings, start)
+            ]
+            create_many(db, CHUNKS_COLLECTION, chunk_docs)
+            fallback_index.add([c["id"] for c in chunk_docs], [doc_id] * len(chunk_docs), embeddings)
+            if USE_SHORTLIST:
+                create_many(db, SHORTLIST_COLLECTION, [
+                    shortlist_doc(chunk["id"], doc_id, embedding)
+                    for chunk, embedding in zip(chunk_docs, embeddings)
+                ])
+        # Re-raise any embedding error from the producer
+        await producer
+    finally:
+        producer.cancel()
+
+
+def backfill_shortlist(db: NexaClient):
+    """Add shortlist entries for chunks stored before the shortlist collection existed."""
+    chunk_ids = db.query(
+        CHUNKS_COLLECTION, {}, limit=SHORTLIST_BACKFILL_LIMIT, projection={"id": 1}, database=DATABASE
+    )
+    indexed = db.query(
+        SHORTLIST_COLLECTION, {}, limit=SHORTLIST_BACKFILL_LIMIT, projection={"chunk_id": 1}, database=DATABASE
+    )
+    missing = list({c["id"] for c in chunk_ids} - {e["chunk_id"] for e in indexed})
+
+    for start in range(0, len(missing), SHORTLIST_BACKFILL_PAGE):
+        page = missing[start:start + SHORTLIST_BACKFILL_PAGE]
+        chunks = db.query(
+            CHUNKS_COLLECTION,
+            {"id": {"$in": page}},
+            limit=len(page),
+            projection={"id": 1, "document_id": 1, "vector": 1},
+            database=DATABASE
+        )
+        create_many(db, SHORTLIST_COLLECTION, [
+            shortlist_doc(c["id"], c["document_id"], c["vector"])
+            for c in chunks
+            if len(c.get("vector") or []) == EMBEDDING_DIMENSIONS
+        ])
+
+
+def shortlist_search(db: NexaClient, vector: list[float], top_k: int) -> list[dict]:
+    """Shortlist candidates on truncated vectors, then rerank them on full vectors."""
+    entries = db.vector_search(
+        SHORTLIST_COLLECTION,
+        vector=shortlist_vector(vector),
+        limit=max(SHORTLIST_CANDIDATES, top_k),
+        dimensions=SHORTLIST_DIMENSIONS,
+        database=DATABASE
+    )
+    ids = [e["chunk_id"] for e in entries if "chunk_id" in e]
+    if not ids:
+        return []
+    candidates = db.query(CHUNKS_COLLECTION, {"id": {"$in": ids}}, limit=len(ids), database=DATABASE)
+    return rerank(candidates, vector, top_k)
+
+
+def _normalized_rows(vectors: list) -> np.ndarray:
+    """(N, D) float32 matrix with L2-normalized rows."""
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(-1, EMBEDDING_DIMENSIONS)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def _load_fallback_block() -> tuple[list[str], list[str], np.ndarray]:
+    """Load all chunk vectors on a dedicated connection (runs in a worker thread)."""
+    db = new_client()
+    try:
+        chunks = db.query(
+            CHUNKS_COLLECTION,
+            {},
+            limit=FALLBACK_INDEX_LIMIT,
+            projection={"id": 1, "document_id": 1, "vector": 1},
+            database=DATABASE
+        )
+    finally:
+        db.disconnect()
+    chunks = [c for c in chunks if len(c.get("vector") or []) == EMBEDDING_DIMENSIONS]
+    return (
+        [c["id"] for c in chunks],
+        [c.get("document_id") for c in chunks],
+        _normalized_rows([c["vector"] for c in chunks]),
+    )
+
+
+class FallbackIndex:
+    """In-memory brute-force cosine index, used when NexaDB vector search fails.
+
+    Loaded on first use and then kept current: uploads append blocks of rows
+    (no copy of the existing matrix) and deletes drop a document's rows.
+    """
+
+    def __init__(self):
+        # (chunk ids, document ids, normalized vectors) per block; None = not loaded
+        self.blocks: Optional[list[tuple[list[str], list[str], np.ndarray]]] = None
+        self.generation = 0  # bumped on every write, to detect writes during a load
+        self.lock = asyncio.Lock()
+
+    async def ensure_loaded(self):
+        """Load the index off the event loop if it has not been loaded yet."""
+        if self.blocks is not None:
+            return
+        async with self.lock:
+            if self.blocks is not None:
+                return
+            for _ in range(FALLBACK_LOAD_ATTEMPTS):
+                generation = self.generation
+                block = await asyncio.to_thread(_load_fallback_block)
+                if self.generation == generation:
+                    break
+            self.blocks = [block]
+
+    def add(self, chunk_ids: list[str], document_ids: list[str], vectors: list):
+        """Append rows for newly stored chunks."""
+        self.generation += 1
+        if self.blocks is None or not chunk_ids:
+            return
+        self.blocks.append((list(chunk_ids), list(document_ids), _normalized_rows(vectors)))
+        if len(self.blocks) > FALLBACK_MAX_BLOCKS:
+            self.blocks = [(
+                [i for ids, _, _ in self.blocks for i in ids],
+                [d for _, doc_ids, _ in self.blocks for d in doc_ids],
+                np.vstack([matrix for _, _, matrix in self.blocks]),
+            )]
+
+    def remove_document(self, document_id: str):
+        """Drop all rows belonging to a document."""
+        self.generation += 1
+        if self.blocks is None:
+            return
+        blocks = []
+        for ids, doc_ids, matrix in self.blocks:
+            keep = [i for i, d in enumerate(doc_ids) if d != document_id]
+            if len(keep) == len(ids):
+                blocks.append((ids, doc_ids, matrix))
+            elif keep:
+                blocks.append(([ids[i] for i in keep], [doc_ids[i] for i in keep], matrix[keep]))
+        self.blocks = blocks
+
+    def search(self, vector: list[float], top_k: int) -> list[tuple[str, float]]:
+        """Top-k (chunk id, cosine score) pairs, best first."""
+        if not self.blocks or top_k <= 0:
+            return []
+        ids = [i for block_ids, _, _ in self.blocks for i in block_ids]
+        if not ids:
+            return []
+
+        q = np.asarray(vector, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1.0
+        scores = np.concatenate([matrix @ q for _, _, matrix in self.blocks])
+
+        k = min(top_k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(ids[i], float(scores[i])) for i in top]
+
+
+fallback_index = FallbackIndex()
+
+
+async def fallback_search(db: NexaClient, vector: list[float], top_k: int) -> list[dict]:
+    """Brute-force cosine search over the in-memory fallback index."""
+    await fallback_index.ensure_loaded()
+    hits = fallback_index.search(vector, top_k)
+    if not hits:
+        return []
+
+    ids = [chunk_id for chunk_id, _ in hits]
+    chunks = db.query(CHUNKS_COLLECTION, {"id": {"$in": ids}}, limit=len(ids), database=DATABASE)
+    by_id = {c["id"]: c for c in chunks}
+    return [
+        {**by_id[chunk_id], "_score": score}
+        for chunk_id, score in hits
+        if chunk_id in by_id
+    ]
+
+
+def seed_stats(db: NexaClient) -> dict:
+    """Create the stats singleton from existing documents (one-time scan)."""
+    docs = db.query(
+        DOCUMENTS_COLLECTION,
+        {},
+        limit=STATS_SEED_LIMIT,
+        projection={"chunks_count": 1, "total_tokens": 1},
+        database=DATABASE
+    )
+    stats = {
+        "id": STATS_ID,
+        "total_documents": len(docs),
+        "total_chunks": sum(doc.get("chunks_count", 0) for doc in docs),
+        "total_tokens": sum(doc.get("total_tokens", 0) for doc in docs),
+    }
+    db.create(STATS_COLLECTION, stats, database=DATABASE)
+    return stats
+
+
+def get_stats_doc(db: NexaClient) -> dict:
+    """Get the stats singleton, seeding it if it does not exist yet."""
+    docs = db.query(STATS_COLLECTION, {"id": STATS_ID}, limit=1, database=DATABASE)
+    return docs[0] if docs else seed_stats(db)
+
+
+def update_stats(db: NexaClient, documents: int, chunks: int, tokens: int):
+    """Apply incremental changes to the stats singleton."""
+    docs = db.query(STATS_COLLECTION, {"id": STATS_ID}, limit=1, database=DATABASE)
+    if not docs:
+        # Seeding scans the current state, which already includes this change
+        seed_stats(db)
+        return
+
+    stats = docs[0]
+    db.update(
+        STATS_COLLECTION,
+        stats["_id"],
+        {
+            "total_documents": max(stats.get("total_documents", 0) + documents, 0),
+            "total_chunks": max(stats.get("total_chunks", 0) + chunks, 0),
+            "total_tokens": max(stats.get("total_tokens", 0) + tokens, 0),
+        },
+        database=DATABASE
+    )
+
+
 def setup_database():
     """Ensure database and collections exist."""
     db = get_client()
@@ -163,12 +766,45 @@ def setup_database():
     except:
         pass
 
+    try:
+        db.create_collection(EMBEDDING_CACHE_COLLECTION, database=DATABASE)
+    except:
+        pass
+
+    try:
+        db.create_collection(STATS_COLLECTION, database=DATABASE)
+    except:
+        pass
+
+    # Seed the stats document if it is missing (also for existing databases)
+    try:
+        get_stats_doc(db)
+    except:
+        pass
+
+    # Matryoshka shortlist collection, backfilled for chunks that predate it
+    if USE_SHORTLIST:
+        try:
+            db.create_collection(
+                SHORTLIST_COLLECTION,
+                database=DATABASE,
+                vector_dimensions=SHORTLIST_DIMENSIONS
+            )
+        except:
+            pass
+
+        try:
+            backfill_shortlist(db)
+        except Exception as e:
+            print(f"[STARTUP] Shortlist backfill failed: {e}")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Setup on startup."""
+    """Connect and setup on startup, disconnect on shutdown."""
     setup_database()
     yield
+    reset_client()
 
 
 # FastAPI app
@@ -228,26 +864,26 @@ async def upload_document(file: UploadFile = File(...)):
             detail=f"Unsupported file type. Allowed: {', '.join(allowed_extensions)}"
         )
 
-    # Read file content
-    content = await file.read()
+    # Starlette already spools uploads to a SpooledTemporaryFile; read from it directly
+    file.file.seek(0)
 
     # Extract text based on file type
     if file_ext == ".pdf":
         try:
-            pdf_reader = PdfReader(io.BytesIO(content))
-            text_parts = []
-            for page in pdf_reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text_parts.append(page_text)
-            text = "\n\n".join(text_parts)
+            # PDF parsing is CPU-heavy; keep it off the event loop
+            text = await asyncio.to_thread(extract_pdf_text, file.file)
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Failed to parse PDF: {str(e)}")
     else:
+        # newline="" keeps \r\n and \r exactly as uploaded
+        reader = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
         try:
-            text = content.decode("utf-8")
+            text = reader.read()
         except UnicodeDecodeError:
             raise HTTPException(status_code=400, detail="File must be UTF-8 encoded text")
+        finally:
+            # Leave the underlying file for Starlette to close
+            reader.detach()
 
     if not text.strip():
         raise HTTPException(status_code=400, detail="File is empty")
@@ -261,35 +897,32 @@ async def upload_document(file: UploadFile = File(...)):
     if not chunks:
         raise HTTPException(status_code=400, detail="Could not extract text from file")
 
+    # Count tokens for the whole document and every chunk in a single batch
+    total_tokens, *chunk_tokens = count_tokens_batch([text, *chunks])
+
     # Create document record
     doc = {
         "id": doc_id,
         "filename": file.filename,
         "chunks_count": len(chunks),
-        "total_tokens": count_tokens(text),
+        "total_tokens": total_tokens,
         "created_at": datetime.now(timezone.utc).isoformat(),
     }
-    db.create(DOCUMENTS_COLLECTION, doc, database=DATABASE)
+    doc_key = db.create(DOCUMENTS_COLLECTION, doc, database=DATABASE)["document_id"]
 
-    # Process chunks and create embeddings
-    for i, chunk_text_content in enumerate(chunks):
-        try:
-            embedding = create_embedding(chunk_text_content)
-
-            chunk = {
-                "id": generate_id(),
-                "document_id": doc_id,
-                "document_name": file.filename,
-                "chunk_index": i,
-                "text": chunk_text_content,
-                "vector": embedding,
-                "tokens": count_tokens(chunk_text_content),
-            }
-            db.create(CHUNKS_COLLECTION, chunk, database=DATABASE)
-        except Exception as e:
-            # If embedding fails, clean up and raise error
-            db.delete(DOCUMENTS_COLLECTION, doc["_id"] if "_id" in doc else doc_id, database=DATABASE)
-            raise HTTPException(status_code=500, detail=f"Failed to create embedding: {str(e)}")
+    # Embed and store chunks
+    try:
+        await store_chunks(db, doc_id, file.filename, chunks, chunk_tokens)
+    except Exception as e:
+        # If embedding fails, clean up and raise error
+        delete_many(db, CHUNKS_COLLECTION, {"document_id": doc_id})
+        if USE_SHORTLIST:
+            delete_many(db, SHORTLIST_COLLECTION, {"document_id": doc_id})
+        fallback_index.remove_document(doc_id)
+        db.delete(DOCUMENTS_COLLECTION, doc_key, database=DATABASE)
+        raise HTTPException(status_code=500, detail=f"Failed to create embedding: {str(e)}")
+
+    update_stats(db, documents=1, chunks=len(chunks), tokens=total_tokens)
 
     return {
         "success": True,
@@ -337,30 +970,42 @@ async def delete_document(doc_id: str):
     doc = docs[0]
 
     # Delete all chunks for this document
-    chunks = db.query(CHUNKS_COLLECTION, {"document_id": doc_id}, limit=1000, database=DATABASE)
-    for chunk in chunks:
-        try:
-            db.delete(CHUNKS_COLLECTION, chunk["_id"], database=DATABASE)
-        except:
-            pass
+    chunks_removed = delete_many(db, CHUNKS_COLLECTION, {"document_id": doc_id})
+    if USE_SHORTLIST:
+        delete_many(db, SHORTLIST_COLLECTION, {"document_id": doc_id})
+    fallback_index.remove_document(doc_id)
 
     # Delete document
     db.delete(DOCUMENTS_COLLECTION, doc["_id"], database=DATABASE)
+    update_stats(db, documents=-1, chunks=-chunks_removed, tokens=-doc.get("total_tokens", 0))
 
     return {
         "success": True,
         "message": "Document deleted successfully",
         "deleted": {
             "document_id": doc_id,
-            "chunks_removed": len(chunks)
+            "chunks_removed": chunks_removed
         }
     }
 
 
-@app.post("/ask", response_model=AskResponse)
-async def ask_question(request: AskRequest):
-    """Ask a question and get an AI-powered answer using RAG."""
+NO_DOCUMENTS_ANSWER = "I don't have any documents to search through. Please upload some documents first."
+
+SYSTEM_PROMPT = """You are a helpful AI assistant that answers questions based on the provided context.
 
+Rules:
+1. Only answer based on the provided context
+2. If the context doesn't contain enough information, say so
+3. Cite your sources by mentioning which document the information came from
+4. Be concise but thorough
+5. If asked about something not in the context, politely explain you can only answer based on the uploaded documents"""
+
+
+async def build_rag_messages(request: AskRequest) -> tuple[Optional[list[dict]], list[dict]]:
+    """Retrieve relevant chunks for a question and build the chat messages.
+
+    Returns (messages, sources); messages is None when there is nothing to search.
+    """
     if not request.question.strip():
         raise HTTPException(status_code=400, detail="Question cannot be empty")
 
@@ -368,28 +1013,30 @@ async def ask_question(request: AskRequest):
 
     # Create embedding for the question
     try:
-        question_embedding = create_embedding(request.question)
+        question_embedding = list(_embed_cached(request.question.strip()))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create question embedding: {str(e)}")
 
     # Vector search for relevant chunks
     try:
-        results = db.vector_search(
-            CHUNKS_COLLECTION,
-            vector=question_embedding,
-            top_k=request.top_k,
-            database=DATABASE
-        )
+        results = []
+        if USE_SHORTLIST:
+            results = shortlist_search(db, question_embedding, request.top_k)
+        if not results:
+            # Empty shortlist (e.g. backfill failed): search the full vectors directly
+            results = db.vector_search(
+                CHUNKS_COLLECTION,
+                vector=query_vector(question_embedding),
+                limit=request.top_k,
+                dimensions=EMBEDDING_DIMENSIONS,
+                database=DATABASE
+            )
     except Exception as e:
-        # Fallback: get all chunks and do manual similarity (less efficient)
-        results = db.query(CHUNKS_COLLECTION, {}, limit=request.top_k, database=DATABASE)
+        # Fallback: brute-force cosine similarity over the in-memory index
+        results = await fallback_search(db, question_embedding, request.top_k)
 
     if not results:
-        return AskResponse(
-            answer="I don't have any documents to search through. Please upload some documents first.",
-            sources=[],
-            tokens_used=0
-        )
+        return None, []
 
     # Build context from retrieved chunks
     context_parts = []
@@ -413,15 +1060,6 @@ async def ask_question(request: AskRequest):
     context = "\n\n---\n\n".join(context_parts)
 
     # Build prompt
-    system_prompt = """You are a helpful AI assistant that answers questions based on the provided context.
-
-Rules:
-1. Only answer based on the provided context
-2. If the context doesn't contain enough information, say so
-3. Cite your sources by mentioning which document the information came from
-4. Be concise but thorough
-5. If asked about something not in the context, politely explain you can only answer based on the uploaded documents"""
-
     user_prompt = f"""Context:
 {context}
 
@@ -431,15 +1069,37 @@ Question: {request.question}
 
 Please provide a helpful answer based on the context above."""
 
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+    return messages, sources
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Format a Server-Sent Events message with a JSON payload."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+@app.post("/ask", response_model=AskResponse)
+async def ask_question(request: AskRequest):
+    """Ask a question and get an AI-powered answer using RAG."""
+    messages, sources = await build_rag_messages(request)
+
+    if messages is None:
+        return AskResponse(
+            answer=NO_DOCUMENTS_ANSWER,
+            sources=[],
+            tokens_used=0
+        )
+
     # Call LLM
     try:
         oai = get_openai_client()
         response = oai.chat.completions.create(
             model=LLM_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
+            messages=messages,
             temperature=0.7,
             max_tokens=1000
         )
@@ -457,23 +1117,63 @@ Please provide a helpful answer based on the context above."""
     )
 
 
+@app.post("/ask/stream")
+async def ask_question_stream(request: AskRequest):
+    """Ask a question and stream the answer as Server-Sent Events.
+
+    Emits one `data: {"content": ...}` message per token delta, then a final
+    `event: sources` message with the sources and tokens used.
+    """
+    messages, sources = await build_rag_messages(request)
+
+    async def event_stream():
+        if messages is None:
+            yield sse_event({"content": NO_DOCUMENTS_ANSWER})
+            yield sse_event({"sources": [], "tokens_used": 0}, event="sources")
+            return
+
+        tokens_used = 0
+        try:
+            oai = get_async_openai_client()
+            stream = await oai.chat.completions.create(
+                model=LLM_MODEL,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1000,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    tokens_used = chunk.usage.total_tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield sse_event({"content": chunk.choices[0].delta.content})
+        except Exception as e:
+            # Headers are already sent, so report failures in-band
+            yield sse_event({"detail": f"Failed to generate answer: {str(e)}"}, event="error")
+            return
+
+        yield sse_event({"sources": sources, "tokens_used": tokens_used}, event="sources")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @app.get("/stats")
 async def get_stats():
     """Get knowledge base statistics."""
     db = get_client()
 
-    docs = db.query(DOCUMENTS_COLLECTION, {}, limit=1000, database=DATABASE)
-    chunks = db.query(CHUNKS_COLLECTION, {}, limit=10000, database=DATABASE)
-
-    total_tokens = sum(doc.get("total_tokens", 0) for doc in docs)
+    stats = get_stats_doc(db)
+    total_documents = stats.get("total_documents", 0)
+    total_chunks = stats.get("total_chunks", 0)
 
     return {
         "success": True,
         "stats": {
-            "total_documents": len(docs),
-            "total_chunks": len(chunks),
-            "total_tokens": total_tokens,
-            "avg_chunks_per_doc": round(len(chunks) / len(docs), 1) if docs else 0
+            "total_documents": total_documents,
+            "total_chunks": total_chunks,
+            "total_tokens": stats.get("total_tokens", 0),
+            "avg_chunks_per_doc": round(total_chunks / total_documents, 1) if total_documents else 0
         }
     }
 